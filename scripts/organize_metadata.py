@@ -4,23 +4,33 @@ Main script for DICOM processing pipeline.
 """
 
 import os
-import sys
+import argparse
 from promis_preprocess.dicom_processing import process_all_dicom_series
-from promis_preprocess.metadata_extraction import load_series_descriptions, save_metadata_to_parquet
+from promis_preprocess.metadata_extraction import load_series_descriptions, load_metadata_from_parquet
 from promis_preprocess.analysis_utils import analyze_processing_results, log_processing_summary, generate_summary_report
 from promis_preprocess.config_loader import config
 
 
 def main():
     """Main processing function."""
+    parser = argparse.ArgumentParser(description='Extract metadata from all DICOM series')
+    parser.add_argument('dicom_raw', nargs='?',
+                       help='Override DICOM raw path')
+    parser.add_argument('metadata', nargs='?',
+                       help='Override metadata output path')
+    parser.add_argument('--workers', type=int,
+                       help='Number of DICOM series processed in parallel (default: CPU count)')
+    
+    args = parser.parse_args()
+    
     # Use default config or allow override via command line
     config_dict = config['paths'].copy()
     
     # Override with command line arguments if provided
-    if len(sys.argv) > 1:
-        config_dict['dicom_raw'] = sys.argv[1]
-    if len(sys.argv) > 2:
-        config_dict['metadata'] = sys.argv[2]
+    if args.dicom_raw:
+        config_dict['dicom_raw'] = args.dicom_raw
+    if args.metadata:
+        config_dict['metadata'] = args.metadata
     
     # Ensure output directory exists
     os.makedirs(config_dict['metadata'], exist_ok=True)
@@ -35,21 +45,22 @@ def main():
     
     # Process all DICOM series
     print("Processing DICOM series...")
-    metadata, stats, log_file = process_all_dicom_series(
+    metadata_file, stats, log_file = process_all_dicom_series(
         config_dict['dicom_raw'], 
         series_descriptions,
-        config_dict['metadata']
+        config_dict['metadata'],
+        max_workers=args.workers
     )
     
     print(f'Processing complete: {stats["processed"]} processed, {stats["errors"]} errors, {stats["warnings"]} warnings')
     
-    # Save metadata to parquet
-    print("Saving metadata...")
-    df_metadata = save_metadata_to_parquet(metadata, config_dict['metadata'])
+    # Load the metadata streamed to parquet during processing
+    print("Loading saved metadata...")
+    df_metadata = load_metadata_from_parquet(metadata_file)
     
     # Generate analysis and reports
     print("Generating analysis and reports...")
-    analyze_processing_results(metadata, stats, log_file)
+    analyze_processing_results(df_metadata, stats, log_file)
     log_processing_summary(stats, log_file)
     generate_summary_report(df_metadata, config_dict['metadata'])
     
@@ -5,8 +5,11 @@ Script to process DICOM studies and resample them to a reference series.
 
 import os
 import argparse
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 import SimpleITK as sitk
 import pandas as pd
+import pyarrow.parquet as pq
 from tqdm import tqdm
 
 from promis_preprocess.config_loader import config
@@ -18,71 +21,126 @@ def select_single_series_per_type(metadata):
     For each study_id, keep only one series per type in SERIES_TO_PROCESS.keys().
     Only keeps studies that have all required series.
     """
-    res = []
     series_types = list(config['series_to_process'].keys())
-    
-    for study_id, group in metadata.groupby('study_id'):
-        found_types = [
-            seq_type
-            for seq_type in series_types
-            if not group[group['generic_sequence_label'] == seq_type].empty
-        ]
-        # Only keep studies that have all required series
-        if set(found_types) == set(series_types):
-            for seq_type in series_types:
-                seq_group = group[group['generic_sequence_label'] == seq_type]
-                # RULE: choose the last one (can adapt: e.g., latest, largest, etc)
-                selected = seq_group.iloc[-1]
-                res.append(selected)
-    
-    return pd.DataFrame(res)
+    candidates = metadata[metadata['generic_sequence_label'].isin(series_types)]
+
+    # Metadata rows arrive in worker completion order, so order by folder path first
+    # to keep the choice deterministic across runs
+    candidates = candidates.sort_values('folder_path', kind='stable')
+
+    # RULE: choose the last one by folder path (can adapt: e.g., latest, largest, etc)
+    selected = candidates.groupby(['study_id', 'generic_sequence_label'], sort=False, observed=True).tail(1)
+
+    # Only keep studies that have all required series
+    type_counts = selected.groupby('study_id')['generic_sequence_label'].nunique()
+    complete_studies = type_counts[type_counts == len(series_types)].index
+    return selected[selected['study_id'].isin(complete_studies)]
+
+
+# Per-thread reader and resampler, reused across series and studies within a worker
+_thread_state = threading.local()
+_series_executor = None
+
+
+def _init_study_worker(num_threads):
+    """Limit ITK to one thread per filter and create the worker's series thread pool."""
+    global _series_executor
+    sitk.ProcessObject_SetGlobalDefaultNumberOfThreads(1)
+    _series_executor = ThreadPoolExecutor(max_workers=max(num_threads, 1))
+
+
+def _get_reader():
+    """Return this thread's DICOM series reader, creating it on first use."""
+    if not hasattr(_thread_state, 'reader'):
+        _thread_state.reader = create_dicom_reader()
+    return _thread_state.reader
+
+
+def _get_resampler():
+    """Return this thread's nearest-neighbour resampler, creating it on first use."""
+    if not hasattr(_thread_state, 'resample'):
+        _thread_state.resample = sitk.ResampleImageFilter()
+        _thread_state.resample.SetInterpolator(sitk.sitkNearestNeighbor)
+    return _thread_state.resample
+
 
+def _resample_and_save(series_path, reference_image, output_path):
+    """Load a DICOM series, resample it onto the reference image grid and save it."""
+    # Filter objects are not thread-safe, so each thread keeps its own resampler
+    resample = _get_resampler()
+    resample.SetReferenceImage(reference_image)
 
-def process_and_save_studies(metadata, series_to_process, reference_series, paths_config):
+    image = load_dicom_image_from_folder(_get_reader(), series_path)
+    resampled_image = resample.Execute(image)
+    sitk.WriteImage(resampled_image, output_path)
+
+
+def _process_one_study(study_id, study_metadata, series_to_process, reference_series, paths_config):
     """
-    Processes and saves Medical Format images for each study in the provided metadata DataFrame.
-    The reference series is used to resample all others.
+    Save the reference series of a single study and resample the remaining
+    series onto it, one thread per additional series.
     """
-    
-    for study_id, study_metadata in tqdm(metadata.groupby('study_id'), 
-                                       total=metadata['study_id'].nunique(), 
-                                       desc="Processing studies"):
-        # Prepare save path
-        patient_id = study_metadata.iloc[0]['patient_id']
-        save_path = os.path.join(
-            paths_config['dicom_processed'], f"{patient_id}/{study_id}/"
-        )
-        os.makedirs(save_path, exist_ok=True)
-
-        # Load reference image
-        ref_row = study_metadata[study_metadata['generic_sequence_label'] == reference_series].iloc[0]
-        reference_series_path = os.path.join(paths_config['dicom_raw'], ref_row['folder_path'])
-        ref_reader = create_dicom_reader()
-        reference_image = load_dicom_image_from_folder(ref_reader, reference_series_path)
-
-        # Save reference image
-        ref_output_path = os.path.join(save_path, f"image_{series_to_process[reference_series]}.mha")
-        sitk.WriteImage(reference_image, ref_output_path)
-
-        # Set up resampler with specified reference image and interpolator
-        resample = sitk.ResampleImageFilter()
-        resample.SetReferenceImage(reference_image)
-        resample.SetInterpolator(sitk.sitkNearestNeighbor)
-
-        # Process remaining series types
+    # Prepare save path
+    patient_id = study_metadata.iloc[0]['patient_id']
+    save_path = os.path.join(
+        paths_config['dicom_processed'], f"{patient_id}/{study_id}/"
+    )
+    os.makedirs(save_path, exist_ok=True)
+
+    # Load reference image
+    ref_row = study_metadata[study_metadata['generic_sequence_label'] == reference_series].iloc[0]
+    reference_series_path = os.path.join(paths_config['dicom_raw'], ref_row['folder_path'])
+    reference_image = load_dicom_image_from_folder(_get_reader(), reference_series_path)
+
+    # Save reference image
+    ref_output_path = os.path.join(save_path, f"image_{series_to_process[reference_series]}.mha")
+    sitk.WriteImage(reference_image, ref_output_path)
+
+    # Process remaining series types concurrently (SimpleITK releases the GIL).
+    # Outside a pool worker there is no shared executor, so use a local one.
+    executor = _series_executor
+    if executor is None:
+        executor = ThreadPoolExecutor(max_workers=max(len(series_to_process) - 1, 1))
+
+    try:
+        futures = []
         for seq_type in series_to_process:
             if seq_type == reference_series:
                 continue
 
             add_row = study_metadata[study_metadata['generic_sequence_label'] == seq_type].iloc[0]
             additional_series_path = os.path.join(paths_config['dicom_raw'], add_row['folder_path'])
-            add_reader = create_dicom_reader()
-            add_image = load_dicom_image_from_folder(add_reader, additional_series_path)
-            resampled_image = resample.Execute(add_image)
-
-            # Save resampled image
             add_output_path = os.path.join(save_path, f"image_{series_to_process[seq_type]}.mha")
-            sitk.WriteImage(resampled_image, add_output_path)
+            futures.append(executor.submit(_resample_and_save, additional_series_path, reference_image, add_output_path))
+
+        for future in futures:
+            future.result()
+    finally:
+        if executor is not _series_executor:
+            executor.shutdown()
+
+
+def process_and_save_studies(metadata, series_to_process, reference_series, paths_config, max_workers=None):
+    """
+    Processes and saves Medical Format images for each study in the provided metadata DataFrame.
+    The reference series is used to resample all others. Studies are processed in parallel
+    worker processes.
+    """
+    num_threads = len(series_to_process) - 1
+
+    grouped = metadata.groupby('study_id', sort=False)
+
+    with ProcessPoolExecutor(max_workers=max_workers, initializer=_init_study_worker,
+                             initargs=(num_threads,)) as executor:
+        futures = [
+            executor.submit(_process_one_study, study_id, study_metadata,
+                            series_to_process, reference_series, paths_config)
+            for study_id, study_metadata in grouped
+        ]
+        for future in tqdm(as_completed(futures),
+                           total=grouped.ngroups,
+                           desc="Processing studies"):
+            future.result()
 
 
 def main():
@@ -94,6 +152,8 @@ def main():
                        help='Override processed output path')
     parser.add_argument('--raw-path', 
                        help='Override DICOM raw path')
+    parser.add_argument('--workers', type=int,
+                       help='Number of studies processed in parallel (default: CPU count)')
     
     args = parser.parse_args()
     
@@ -117,8 +177,13 @@ def main():
     
     # Load metadata
     print("Loading metadata...")
-    metadata = pd.read_parquet(os.path.join(config_dict['metadata'], 'series_metadata.parquet'))
-    print(f"Loaded {len(metadata)} series from {metadata['study_id'].nunique()} studies")
+    metadata_file = os.path.join(config_dict['metadata'], 'series_metadata.parquet')
+    metadata = pq.read_table(
+        metadata_file,
+        columns=['study_id', 'patient_id', 'generic_sequence_label', 'folder_path'],
+        filters=[('generic_sequence_label', 'in', list(config['series_to_process'].keys()))],
+    ).to_pandas()
+    print(f"Loaded {len(metadata)} candidate series from {metadata['study_id'].nunique()} studies")
     
     # Filter to studies with all required series
     print("Filtering studies with all required series...")
@@ -128,12 +193,13 @@ def main():
     if len(metadata_filtered) == 0:
         print("No studies found with all required series types!")
         print("Available series types:")
-        print(metadata['generic_sequence_label'].value_counts())
+        print(pd.read_parquet(metadata_file, columns=['generic_sequence_label'])['generic_sequence_label'].value_counts())
         return
     
     # Process and save studies
     print("Processing studies...")
-    process_and_save_studies(metadata_filtered, config['series_to_process'], config['reference_series'], config_dict)
+    process_and_save_studies(metadata_filtered, config['series_to_process'], config['reference_series'], config_dict,
+                             max_workers=args.workers)
     
     print("Processing completed successfully!")
 
@@ -2,11 +2,10 @@
 Analysis and reporting utilities for DICOM processing.
 """
 
-import pandas as pd
 import os
 
 
-def analyze_processing_results(metadata, stats, log_file):
+def analyze_processing_results(df, stats, log_file):
     """Analyze the results of DICOM processing."""
     print("=== Processing Analysis ===")
     print(f"Total series processed: {stats['processed']}")
@@ -15,8 +14,7 @@ def analyze_processing_results(metadata, stats, log_file):
     print(f"Detailed log available at: {log_file}")
     
     # Analyze metadata
-    if metadata:
-        df = pd.DataFrame(metadata)
+    if not df.empty:
         print(f"\nMetadata analysis:")
         print(f"  - Unique patients: {df['patient_id'].nunique()}")
         print(f"  - Unique series descriptions: {df['series_description'].nunique()}")
@@ -48,6 +46,12 @@ def log_processing_summary(stats, log_file):
     return analysis'''
 
 
+def _format_counts(column):
+    """Format the non-zero value counts of a column as indented report lines."""
+    counts = column.astype('category').value_counts()
+    return "".join(f"  {value}: {count}\n" for value, count in counts[counts > 0].items())
+
+
 def generate_summary_report(df_metadata, output_path):
     """Generate a comprehensive summary report."""
     report_file = os.path.join(output_path, "processing_summary.txt")
@@ -61,15 +65,12 @@ def generate_summary_report(df_metadata, output_path):
         f.write(f"Unique series descriptions: {df_metadata['series_description'].nunique()}\n\n")
         
         f.write("Scanner Types:\n")
-        for scanner_type, count in df_metadata['scanner_type'].value_counts().items():
-            f.write(f"  {scanner_type}: {count}\n")
+        f.write(_format_counts(df_metadata['scanner_type']))
         
         f.write("\nGeneric Sequence Labels:\n")
-        for label, count in df_metadata['generic_sequence_label'].value_counts().items():
-            f.write(f"  {label}: {count}\n")
+        f.write(_format_counts(df_metadata['generic_sequence_label']))
         
         f.write("\nScanner Manufacturers:\n")
-        for manufacturer, count in df_metadata['scanner_manufacturer'].value_counts().items():
-            f.write(f"  {manufacturer}: {count}\n")
+        f.write(_format_counts(df_metadata['scanner_manufacturer']))
     
     print(f"Summary report saved to {report_file}")
@@ -3,6 +3,12 @@ Configuration loader for YAML-based configuration.
 """
 import yaml
 from pathlib import Path
+from types import MappingProxyType
+
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:  # PyYAML built without libyaml
+    from yaml import SafeLoader
 
 
 def load_config(config_path=None):
@@ -13,8 +19,8 @@ def load_config(config_path=None):
         config_path = project_root / "config.yaml"
     
     with open(config_path, 'r') as f:
-        return yaml.safe_load(f)
+        return yaml.load(f, Loader=SafeLoader)
 
 
-# Load and export the configuration
-config = load_config()
+# Load and export the configuration (read-only at the top level)
+config = MappingProxyType(load_config())
@@ -2,14 +2,35 @@
 Core DICOM processing functions.
 """
 
+import logging
+import math
 import os
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from itertools import islice
 import SimpleITK as sitk
 from tqdm import tqdm
 from datetime import datetime
 
+from .metadata_extraction import (
+    METADATA_CHUNK_SIZE,
+    METADATA_COLUMNS,
+    extract_metadata_from_header,
+    open_metadata_writer,
+    write_metadata_chunk,
+)
+
 # disable SimpleITK warnings
 sitk.ProcessObject_GlobalWarningDisplayOff()
 
+logger = logging.getLogger('promis.dicom')
+
+
+class _BufferedStreamHandler(logging.StreamHandler):
+    """StreamHandler that leaves flushing to the stream's own buffer instead of flushing per record."""
+
+    def flush(self):
+        pass
+
 
 def create_dicom_reader():
     """Create and configure a SimpleITK ImageSeriesReader."""
@@ -28,86 +49,222 @@ def load_dicom_image_from_folder(reader, folder_path):
     return image
 
 
-def process_dicom_series(path, series_descriptions, base_path, log_file):
-    """Process a single DICOM series and return metadata or None if failed."""
-    from metadata_extractor import extract_metadata_from_reader
+def _read_slice_information(file_name):
+    """Read the header of a single DICOM file without decoding its pixel data."""
+    reader = sitk.ImageFileReader()
+    reader.SetFileName(file_name)
+    reader.LoadPrivateTagsOn()
+    reader.ReadImageInformation()
+    return reader
+
+
+def read_dicom_series_information(folder_path):
+    """
+    Read size and spacing of a DICOM series from the headers of its first and
+    last files, without decoding any pixel data.
+    The slice count is the number of files times the frames per file, so
+    multi-frame files are counted like the full series read. For single-frame
+    series the z-spacing is (last origin - first origin) / (n - 1) over the n
+    files, or 1.0 if those origins coincide; multi-frame files keep the
+    z-spacing reported in their header.
+    Returns (header_reader, size, spacing); header_reader holds the first file's tags.
+    """
+    dicom_names = sitk.ImageSeriesReader.GetGDCMSeriesFileNames(folder_path)
+    if not dicom_names:
+        raise RuntimeError(f"No DICOM series found in {folder_path}")
+    
+    header = _read_slice_information(dicom_names[0])
+    header_size = header.GetSize()
+    frames_per_file = header_size[2] if len(header_size) > 2 else 1
+    size = tuple(header_size[:2]) + (len(dicom_names) * frames_per_file,)
+    spacing = tuple(header.GetSpacing())
+    if len(spacing) < 3:
+        spacing = spacing + (1.0,)
+    
+    # Slice spacing follows from the distance between the outer slice origins;
+    # like ImageSeriesReader, fall back to 1.0 when they coincide
+    if len(dicom_names) > 1 and frames_per_file == 1:
+        last = _read_slice_information(dicom_names[-1])
+        distance = math.dist(header.GetOrigin(), last.GetOrigin())
+        if math.isclose(distance, 0.0, abs_tol=1e-6):
+            spacing = spacing[:2] + (1.0,)
+        else:
+            spacing = spacing[:2] + (distance / (len(dicom_names) - 1),)
     
-    reader = create_dicom_reader()
+    return header, size, spacing
+
+
+def _iter_dicom_dirs(root):
+    """Yield (path, num_dcm_files) for every directory under root (inclusive) that contains .dcm files."""
+    subdirs = []
+    num_dcm = 0
+    try:
+        with os.scandir(root) as it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=False):
+                    subdirs.append(entry.path)
+                elif entry.name.endswith('.dcm'):
+                    num_dcm += 1
+    except OSError:
+        return
+    
+    if num_dcm:
+        yield root, num_dcm
+    for subdir in subdirs:
+        yield from _iter_dicom_dirs(subdir)
+
+
+def process_dicom_series(path, series_descriptions, base_path, num_files=None):
+    """
+    Process a single DICOM series. num_files is the number of .dcm files in
+    path; it is counted here if the caller does not already know it.
+
+    Returns a picklable (metadata, status, log_records) tuple so it can run in a
+    worker process; metadata is None if the series failed to load. Each log
+    record is a (level, msg, args) tuple to be emitted through the parent's logger.
+    """
+    log_records = []
     
     try:
-        image = load_dicom_image_from_folder(reader, path)
+        header, size, spacing = read_dicom_series_information(path)
+        if num_files is None:
+            num_files = sum(1 for e in os.scandir(path) if e.name.endswith('.dcm'))
         
         # Extract metadata 
-        metadata = extract_metadata_from_reader(reader, image, path, series_descriptions, base_path)
+        metadata = extract_metadata_from_header(header, size, spacing, path, series_descriptions, base_path, num_files)
         
         # Check for slice count mismatch 
-        num_files = len(os.listdir(path))
-        num_slices = image.GetSize()[2]
+        num_slices = size[2]
         if num_files != num_slices:
-            timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-            with open(log_file, 'a') as f:
-                f.write(f"[{timestamp}] WARNING: {path} contains {num_files} DICOM files, but loaded series has {num_slices} slices\n")
-            return metadata, 'warning'
+            log_records.append((
+                logging.WARNING,
+                "%s contains %d DICOM files, but loaded series has %d slices",
+                (path, num_files, num_slices),
+            ))
+            return metadata, 'warning', log_records
         
-        return metadata, None
+        return metadata, None, log_records
         
     except Exception as e:
-        timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        with open(log_file, 'a') as f:
-            f.write(f"[{timestamp}] ERROR: {path}: {str(e)}\n")
-        return None, str(e)
+        log_records.append((logging.ERROR, "%s: %s", (path, str(e))))
+        return None, str(e), log_records
+
+
+# Per-process state shared by every task, set once by _init_worker
+_WORKER = {}
 
 
-def process_all_dicom_series(dicom_path, series_descriptions, output_path):
-    """Process all DICOM series in the given path."""
-    metadata = []
+def _init_worker(series_descriptions, base_path):
+    """Store the lookup tables each worker needs so tasks only carry their path."""
+    _WORKER['series_descriptions'] = series_descriptions
+    _WORKER['base_path'] = base_path
+
+
+def _process_dicom_series_task(path, num_files):
+    """Pool task wrapper around process_dicom_series using the worker's shared state."""
+    return process_dicom_series(path, _WORKER['series_descriptions'], _WORKER['base_path'], num_files)
+
+
+def process_all_dicom_series(dicom_path, series_descriptions, output_path, max_workers=None,
+                             filename='series_metadata.parquet'):
+    """
+    Process all DICOM series in the given path using a pool of worker processes.
+    Metadata is streamed to a parquet file in output_path in chunks of
+    METADATA_CHUNK_SIZE records; the path to that file is returned.
+    """
+    metadata = {key: [] for key in METADATA_COLUMNS}
     stats = {'processed': 0, 'errors': 0, 'warnings': 0}
     
     # Ensure output directory exists
     os.makedirs(output_path, exist_ok=True)
+    start_timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
     
-    # Create log file
-    log_file = os.path.join(output_path, 'processing_log.txt')
-    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    with open(log_file, 'w') as f:
-        f.write(f"DICOM Processing Log - Started at {timestamp}\n")
-        f.write("=" * 50 + "\n\n")
-    
-    # Get all DICOM directories that contain .dcm files
-    dicom_dirs = []
-    for root, dirs, files in os.walk(dicom_path):
-        if any(f.endswith('.dcm') for f in files):
-            dicom_dirs.append(root)
+    # Get all DICOM directories that contain .dcm files, largest first so
+    # long series start early and small ones backfill idle workers
+    dicom_dirs = sorted(_iter_dicom_dirs(dicom_path), key=lambda d: d[1], reverse=True)
     
     total_dirs = len(dicom_dirs)
+    log_file = os.path.join(output_path, 'processing_log.txt')
+    metadata_file = os.path.join(output_path, filename)
     
     print(f"Found {total_dirs} DICOM directories to process...")
     print(f"Logging to: {log_file}")
     
-    with tqdm(total=total_dirs, desc="Processing DICOM", unit="dir") as pbar:
-        for path in dicom_dirs:
-            result, error = process_dicom_series(path, series_descriptions, dicom_path, log_file)
-            
-            if result is not None:
-                metadata.append(result)
-                stats['processed'] += 1
-                if error == 'warning':
-                    stats['warnings'] += 1
-            else:
-                stats['errors'] += 1
-            
-            # Update progress bar with current stats
-            pbar.set_postfix({
-                'Processed': stats['processed'],
-                'Errors': stats['errors'],
-                'Warnings': stats['warnings']
-            })
-            pbar.update(1)
+    if max_workers is None:
+        max_workers = os.cpu_count()
+    
+    # Discovered paths are rooted at dicom_path, so folder paths can be sliced off this prefix
+    base_prefix = os.path.join(dicom_path, '')
     
-    # Write final summary to log
-    end_timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    with open(log_file, 'a') as f:
-        f.write(f"\nProcessing completed at {end_timestamp}\n")
-        f.write(f"Final stats: {stats['processed']} processed, {stats['errors']} errors, {stats['warnings']} warnings\n")
+    # Single block-buffered log handle owned by this process; workers hand their
+    # log records back and everything is flushed in 64 KiB writes
+    with open(log_file, 'w', buffering=1 << 16) as log_fh:
+        log_fh.write(f"DICOM Processing Log - Started at {start_timestamp}\n")
+        log_fh.write("=" * 50 + "\n\n")
+        
+        writer = open_metadata_writer(metadata_file)
+        
+        handler = _BufferedStreamHandler(log_fh)
+        handler.setFormatter(logging.Formatter('[%(asctime)s] %(levelname)s: %(message)s',
+                                               datefmt="%Y-%m-%d %H:%M:%S"))
+        # Route records only to the run's log file for the duration of this call
+        previous_level, previous_propagate = logger.level, logger.propagate
+        logger.addHandler(handler)
+        logger.setLevel(logging.INFO)
+        logger.propagate = False
+        
+        try:
+            with ProcessPoolExecutor(max_workers=max_workers, initializer=_init_worker,
+                                     initargs=(series_descriptions, base_prefix)) as executor, \
+                    tqdm(total=total_dirs, desc="Processing DICOM", unit="dir") as pbar:
+                # Bound the number of queued tasks; new ones are submitted as others finish
+                pending = set()
+                remaining_dirs = iter(dicom_dirs)
+                max_pending = 2 * max_workers
+                while True:
+                    for path, num_files in islice(remaining_dirs, max_pending - len(pending)):
+                        pending.add(executor.submit(_process_dicom_series_task, path, num_files))
+                    if not pending:
+                        break
+                    
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        result, error, log_records = future.result()
+                        for level, msg, args in log_records:
+                            logger.log(level, msg, *args)
+                        
+                        if result is not None:
+                            for key, value in result.items():
+                                metadata[key].append(value)
+                            if len(metadata['patient_id']) >= METADATA_CHUNK_SIZE:
+                                write_metadata_chunk(writer, metadata)
+                            stats['processed'] += 1
+                            if error == 'warning':
+                                stats['warnings'] += 1
+                        else:
+                            stats['errors'] += 1
+                        
+                        # Update progress bar with current stats
+                        pbar.set_postfix({
+                            'Processed': stats['processed'],
+                            'Errors': stats['errors'],
+                            'Warnings': stats['warnings']
+                        })
+                        pbar.update(1)
+        finally:
+            try:
+                # Flush whatever was collected, even if processing was interrupted
+                if metadata['patient_id']:
+                    write_metadata_chunk(writer, metadata)
+            finally:
+                writer.close()
+                logger.removeHandler(handler)
+                logger.setLevel(previous_level)
+                logger.propagate = previous_propagate
+        
+        # Write final summary to log
+        end_timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        log_fh.write(f"\nProcessing completed at {end_timestamp}\n")
+        log_fh.write(f"Final stats: {stats['processed']} processed, {stats['errors']} errors, {stats['warnings']} warnings\n")
     
-    return metadata, stats, log_file
+    return metadata_file, stats, log_file
@@ -3,57 +3,113 @@ Metadata extraction and processing utilities.
 """
 
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
 import os
 from .config_loader import config
 
 
+# Low-cardinality columns are stored dictionary-encoded (categorical in pandas)
+_category = pa.dictionary(pa.int32(), pa.string())
+
+# Schema of the per-series metadata records, in column order
+METADATA_SCHEMA = pa.schema([
+    ('patient_id', pa.string()),
+    ('study_id', pa.string()),
+    ('series_id', pa.string()),
+    ('scanner_type', _category),
+    ('scanner_manufacturer', _category),
+    ('scanner_model', _category),
+    ('magnetic_field_strength', _category),
+    ('series_description', _category),
+    ('generic_sequence_label', _category),
+    ('num_dicom_files', pa.int64()),
+    ('num_loaded_slices', pa.int64()),
+    ('size', pa.list_(pa.int64())),
+    ('pixel_spacing', pa.list_(pa.float64())),
+    ('folder_path', pa.string()),
+])
+
+METADATA_COLUMNS = tuple(METADATA_SCHEMA.names)
+
+# Number of records buffered in memory before being written as one row group
+METADATA_CHUNK_SIZE = 8192
+
+
 def load_series_descriptions(series_descriptions_path):
-    """Load and preprocess series descriptions from Excel file."""
+    """
+    Load and preprocess series descriptions from Excel file.
+    Returns a dict mapping (patient_id, series_description) to generic_sequence_label.
+    """
     series_descriptions = pd.read_excel(series_descriptions_path)
     series_descriptions.columns = ['patient_id', 'series_description', 'generic_sequence_label']
-    series_descriptions['series_description'] = series_descriptions['series_description'].str.replace(' ', '')
+    series_descriptions['series_description'] = series_descriptions['series_description'].str.replace(' ', '', regex=False)
+    # Blank or numeric label cells must not reach the string-typed parquet schema
+    series_descriptions['generic_sequence_label'] = series_descriptions['generic_sequence_label'].fillna('unknown').astype(str)
     series_descriptions = series_descriptions.iloc[1:].set_index(['patient_id', 'series_description'])
-    return series_descriptions
+    return series_descriptions['generic_sequence_label'].to_dict()
 
 
-def extract_metadata_from_reader(reader, image, path, series_descriptions, base_path):
-    """Extract metadata from DICOM reader and image."""
-    patient_id = reader.GetMetaData(0, config['dicom_tags']['patient_id'])
-    series_description = reader.GetMetaData(0, config['dicom_tags']['series_description'])
+def extract_metadata_from_header(header, size, spacing, path, series_descriptions, base_path, num_files):
+    """
+    Extract metadata from a DICOM header reader and the series size and spacing.
+    folder_path is made relative to base_path; passing base_path with a trailing
+    separator lets this be done by slicing instead of os.path.relpath.
+    """
+    folder_path = ''
+    if base_path.endswith(os.sep) and path.startswith(base_path):
+        folder_path = path[len(base_path):]
+    if not folder_path:
+        folder_path = os.path.relpath(path, base_path)
     
-    # Get generic sequence label with error handling
-    try:
-        generic_sequence_label = series_descriptions.loc[
-            (patient_id, series_description.replace(' ', '')), 
-            'generic_sequence_label'
-        ]
-    except KeyError:
+    patient_id = header.GetMetaData(config['dicom_tags']['patient_id'])
+    series_description = header.GetMetaData(config['dicom_tags']['series_description'])
+    
+    # Get generic sequence label, falling back to 'unknown'
+    generic_sequence_label = series_descriptions.get((patient_id, series_description.replace(' ', '')))
+    if generic_sequence_label is None:
         generic_sequence_label = 'unknown'
         print(f"Warning: No generic sequence label found for patient {patient_id}, series {series_description}")
     
     return {
         'patient_id': patient_id,
-        'study_id': reader.GetMetaData(0, config['dicom_tags']['study_id']),
-        'series_id': reader.GetMetaData(0, config['dicom_tags']['series_id']),
-        'scanner_type': reader.GetMetaData(0, config['dicom_tags']['scanner_type']),
-        'scanner_manufacturer': reader.GetMetaData(0, config['dicom_tags']['scanner_manufacturer']),
-        'scanner_model': reader.GetMetaData(0, config['dicom_tags']['scanner_model']),
-        'magnetic_field_strength': reader.GetMetaData(0, config['dicom_tags']['magnetic_field_strength']),
+        'study_id': header.GetMetaData(config['dicom_tags']['study_id']),
+        'series_id': header.GetMetaData(config['dicom_tags']['series_id']),
+        'scanner_type': header.GetMetaData(config['dicom_tags']['scanner_type']),
+        'scanner_manufacturer': header.GetMetaData(config['dicom_tags']['scanner_manufacturer']),
+        'scanner_model': header.GetMetaData(config['dicom_tags']['scanner_model']),
+        'magnetic_field_strength': header.GetMetaData(config['dicom_tags']['magnetic_field_strength']),
         'series_description': series_description,
         'generic_sequence_label': generic_sequence_label,
-        'num_dicom_files': len(os.listdir(path)),
-        'num_loaded_slices': image.GetSize()[2],
-        'size': image.GetSize(),
-        'pixel_spacing': image.GetSpacing(),
-        'folder_path': os.path.relpath(path, base_path)
+        'num_dicom_files': num_files,
+        'num_loaded_slices': size[2],
+        'size': size,
+        'pixel_spacing': spacing,
+        'folder_path': folder_path
     }
 
 
-def save_metadata_to_parquet(metadata, output_path, filename='series_metadata.parquet'):
-    """Save metadata to parquet file."""
-    df_metadata = pd.DataFrame(metadata)
-    full_path = os.path.join(output_path, filename)
-    df_metadata.to_parquet(full_path)
-    print(f"Metadata saved to {full_path}")
+def open_metadata_writer(full_path):
+    """Open a parquet writer for streaming metadata records to full_path."""
+    return pq.ParquetWriter(
+        full_path,
+        METADATA_SCHEMA,
+        compression='zstd',
+        compression_level=3,
+        use_dictionary=True,
+    )
+
+
+def write_metadata_chunk(writer, metadata):
+    """Write buffered column-oriented metadata (dict of lists) as one row group and clear the buffer."""
+    writer.write_table(pa.Table.from_pydict(metadata, schema=METADATA_SCHEMA))
+    for values in metadata.values():
+        values.clear()
+
+
+def load_metadata_from_parquet(full_path):
+    """Load the metadata written by process_all_dicom_series into a DataFrame."""
+    df_metadata = pd.read_parquet(full_path)
+    print(f"Loaded metadata from {full_path}")
     print(f"DataFrame shape: {df_metadata.shape}")
     return df_metadata
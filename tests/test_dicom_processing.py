@@ -0,0 +1,78 @@
+"""
+Check that the header-only series geometry matches a full pixel read.
+"""
+
+import os
+
+import pytest
+
+sitk = pytest.importorskip("SimpleITK")
+pytest.importorskip("pyarrow")
+pytest.importorskip("pandas")
+pytest.importorskip("tqdm")
+
+from promis_preprocess.dicom_processing import (
+    create_dicom_reader,
+    load_dicom_image_from_folder,
+    read_dicom_series_information,
+)
+
+
+SERIES_TAGS = {
+    "0008|0060": "CT",
+    "0008|103e": "synthetic",
+    "0010|0020": "patient",
+    "0020|000d": "1.2.826.0.1.3680043.2.1125.1",
+    "0020|000e": "1.2.826.0.1.3680043.2.1125.1.1",
+    "0020|0037": "1\\0\\0\\0\\1\\0",
+}
+
+
+def _write_slices(folder, num_slices, slice_spacing):
+    """Write a single-frame series; slice_spacing=0 puts every slice at the same origin."""
+    image = sitk.Image([8, 8, num_slices], sitk.sitkInt16)
+    image.SetSpacing([0.7, 0.7, slice_spacing or 1.0])
+
+    writer = sitk.ImageFileWriter()
+    writer.KeepOriginalImageUIDOn()
+    for i in range(num_slices):
+        image_slice = image[:, :, i]
+        for tag, value in SERIES_TAGS.items():
+            image_slice.SetMetaData(tag, value)
+        image_slice.SetMetaData("0020|0032", f"0\\0\\{i * slice_spacing}")
+        image_slice.SetMetaData("0020|0013", str(i + 1))
+        image_slice.SetMetaData("0008|0018", f"{SERIES_TAGS['0020|000e']}.{i + 1}")
+        writer.SetFileName(os.path.join(folder, f"{i:03d}.dcm"))
+        writer.Execute(image_slice)
+
+
+def _write_multiframe(folder, num_frames):
+    """Write a series stored as one multi-frame file."""
+    image = sitk.Image([8, 8, num_frames], sitk.sitkInt16)
+    image.SetSpacing([0.7, 0.7, 2.5])
+    for tag, value in SERIES_TAGS.items():
+        image.SetMetaData(tag, value)
+    sitk.WriteImage(image, os.path.join(folder, "000.dcm"))
+
+
+def _assert_matches_full_read(folder):
+    _, size, spacing = read_dicom_series_information(str(folder))
+    image = load_dicom_image_from_folder(create_dicom_reader(), str(folder))
+
+    assert size == tuple(image.GetSize())
+    assert spacing == pytest.approx(image.GetSpacing())
+
+
+def test_series_information_matches_full_read(tmp_path):
+    _write_slices(tmp_path, num_slices=5, slice_spacing=2.5)
+    _assert_matches_full_read(tmp_path)
+
+
+def test_series_information_with_coincident_origins(tmp_path):
+    _write_slices(tmp_path, num_slices=5, slice_spacing=0)
+    _assert_matches_full_read(tmp_path)
+
+
+def test_series_information_multiframe(tmp_path):
+    _write_multiframe(tmp_path, num_frames=7)
+    _assert_matches_full_read(tmp_path)